@@ -12,6 +12,35 @@ load_dotenv()
 
 CHUNK_SIZE = 10000  # Larger chunks for faster batch insert
 
+# Aggregates General Payments rows into the rollup key. {year} is the program
+# year expression and {where} selects the source rows. Malformed years, NPIs and
+# amounts are handled here rather than failing the whole load.
+GENERAL_ROLLUP_QUERY = """
+    SELECT program_year, covered_recipient_npi, teaching_hospital_id, manufacturer_id,
+           MAX(manufacturer_name) AS manufacturer_name, nature_of_payment,
+           COUNT(*) AS payment_count, SUM(amount) AS total_amount,
+           MIN(amount) AS min_amount, MAX(amount) AS max_amount
+    FROM (
+        SELECT {year} AS program_year,
+               npi AS covered_recipient_npi,
+               -- Teaching hospitals have no NPI; key them by their hospital ID instead
+               CASE WHEN npi IS NULL THEN NULLIF(teaching_hospital_id, '') END AS teaching_hospital_id,
+               NULLIF(applicable_manufacturer_or_applicable_gpo_making_payment_id, '') AS manufacturer_id,
+               NULLIF(applicable_manufacturer_or_applicable_gpo_making_payment_name, '') AS manufacturer_name,
+               NULLIF(nature_of_payment_or_transfer_of_value, '') AS nature_of_payment,
+               ROUND(total_amount_of_payment_usdollars::NUMERIC, 2) AS amount
+        FROM (
+            SELECT g.*,
+                   CASE WHEN btrim(covered_recipient_npi) ~ '^[0-9]{{1,10}}$'
+                        THEN btrim(covered_recipient_npi) END AS npi
+            FROM cms_open_payments_general_all g
+            {where}
+        ) g
+        WHERE btrim(total_amount_of_payment_usdollars) ~ '^-?[0-9]+(\\.[0-9]*)?$'
+    ) src
+    GROUP BY program_year, covered_recipient_npi, teaching_hospital_id, manufacturer_id, nature_of_payment
+"""
+
 def get_latest_open_payments_url():
     base_url = "https://download.cms.gov/openpayments/"
     current_year = datetime.now().year
@@ -76,6 +105,150 @@ def import_csv_to_table(cur, filepath, table_name, chunk_size=CHUNK_SIZE):
         if batch:
             insert_batch(cur, table_name, columns, batch)
 
+def create_rollup_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS cms_open_payments_general_rollup (
+        program_year INT NOT NULL,
+        covered_recipient_npi VARCHAR(10),
+        teaching_hospital_id TEXT,
+        manufacturer_id TEXT,
+        manufacturer_name TEXT,
+        nature_of_payment TEXT,
+        payment_count INT NOT NULL,
+        total_amount NUMERIC(16, 2) NOT NULL,
+        min_amount NUMERIC(16, 2) NOT NULL,
+        max_amount NUMERIC(16, 2) NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS cms_op_general_rollup_npi_idx
+        ON cms_open_payments_general_rollup (program_year, covered_recipient_npi);
+    CREATE INDEX IF NOT EXISTS cms_op_general_rollup_hospital_idx
+        ON cms_open_payments_general_rollup (program_year, teaching_hospital_id);
+    CREATE INDEX IF NOT EXISTS cms_op_general_rollup_mfr_idx
+        ON cms_open_payments_general_rollup (program_year, manufacturer_id);
+
+    CREATE TABLE IF NOT EXISTS cms_open_payments_recipient_rollup (
+        program_year INT NOT NULL,
+        covered_recipient_npi VARCHAR(10),
+        teaching_hospital_id TEXT,
+        payment_count INT NOT NULL,
+        total_amount NUMERIC(16, 2) NOT NULL,
+        min_amount NUMERIC(16, 2) NOT NULL,
+        max_amount NUMERIC(16, 2) NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS cms_op_recipient_rollup_npi_idx
+        ON cms_open_payments_recipient_rollup (program_year, covered_recipient_npi);
+    CREATE INDEX IF NOT EXISTS cms_op_recipient_rollup_hospital_idx
+        ON cms_open_payments_recipient_rollup (program_year, teaching_hospital_id);
+
+    CREATE TABLE IF NOT EXISTS cms_open_payments_manufacturer_rollup (
+        program_year INT NOT NULL,
+        manufacturer_id TEXT,
+        manufacturer_name TEXT,
+        payment_count INT NOT NULL,
+        recipient_count INT NOT NULL,
+        total_amount NUMERIC(16, 2) NOT NULL,
+        min_amount NUMERIC(16, 2) NOT NULL,
+        max_amount NUMERIC(16, 2) NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS cms_op_manufacturer_rollup_mfr_idx
+        ON cms_open_payments_manufacturer_rollup (program_year, manufacturer_id);
+    """)
+
+def max_general_id(cur):
+    cur.execute("SELECT to_regclass('cms_open_payments_general_all') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM cms_open_payments_general_all")
+    return cur.fetchone()[0]
+
+def build_rollups(cur, year, after_id=None):
+    """Rebuild the rollups from the raw General Payments rows.
+
+    With after_id, aggregates the rows loaded after that id, using year for
+    rows with a malformed Program_Year. Without it, backfills the rows already
+    in the raw table whose Program_Year is year.
+    """
+    if after_id is None:
+        year_expr = "%(year)s"
+        where = "WHERE btrim(program_year) = %(year_text)s"
+    else:
+        year_expr = "CASE WHEN btrim(program_year) ~ '^[0-9]{4}$' THEN btrim(program_year)::INT ELSE %(year)s END"
+        where = "WHERE id > %(after_id)s"
+    params = {"year": year, "year_text": str(year), "after_id": after_id}
+
+    # Aggregation runs in Postgres so memory stays bounded however many keys a year has
+    cur.execute("DROP TABLE IF EXISTS cms_open_payments_rollup_stage")
+    cur.execute(
+        "CREATE TEMP TABLE cms_open_payments_rollup_stage AS "
+        + GENERAL_ROLLUP_QUERY.format(year=year_expr, where=where),
+        params
+    )
+    cur.execute("SELECT DISTINCT program_year FROM cms_open_payments_rollup_stage ORDER BY program_year")
+    years = [row[0] for row in cur.fetchall()]
+    if not years:
+        return
+    print(f"📊 Building General Payments rollups for {', '.join(map(str, years))}")
+
+    # Rollups are replaced per program year so a re-import never double counts
+    for table in ("cms_open_payments_general_rollup",
+                  "cms_open_payments_recipient_rollup",
+                  "cms_open_payments_manufacturer_rollup"):
+        cur.execute(f"DELETE FROM {table} WHERE program_year = ANY(%s)", (years,))
+
+    cur.execute("""
+        INSERT INTO cms_open_payments_general_rollup (
+            program_year, covered_recipient_npi, teaching_hospital_id, manufacturer_id,
+            manufacturer_name, nature_of_payment, payment_count, total_amount, min_amount, max_amount
+        )
+        SELECT program_year, covered_recipient_npi, teaching_hospital_id, manufacturer_id,
+               manufacturer_name, nature_of_payment, payment_count, total_amount, min_amount, max_amount
+        FROM cms_open_payments_rollup_stage
+    """)
+    cur.execute("DROP TABLE cms_open_payments_rollup_stage")
+
+    # Coarser rollups are derived from the fine-grained one, not the raw table
+    cur.execute("""
+        INSERT INTO cms_open_payments_recipient_rollup (
+            program_year, covered_recipient_npi, teaching_hospital_id,
+            payment_count, total_amount, min_amount, max_amount
+        )
+        SELECT program_year, covered_recipient_npi, teaching_hospital_id, SUM(payment_count),
+               SUM(total_amount), MIN(min_amount), MAX(max_amount)
+        FROM cms_open_payments_general_rollup
+        WHERE program_year = ANY(%s)
+          AND (covered_recipient_npi IS NOT NULL OR teaching_hospital_id IS NOT NULL)
+        GROUP BY program_year, covered_recipient_npi, teaching_hospital_id
+    """, (years,))
+    cur.execute("""
+        INSERT INTO cms_open_payments_manufacturer_rollup (
+            program_year, manufacturer_id, manufacturer_name, payment_count, recipient_count,
+            total_amount, min_amount, max_amount
+        )
+        SELECT program_year, manufacturer_id, MAX(manufacturer_name), SUM(payment_count),
+               COUNT(DISTINCT COALESCE(covered_recipient_npi, 'TH:' || teaching_hospital_id)), SUM(total_amount),
+               MIN(min_amount), MAX(max_amount)
+        FROM cms_open_payments_general_rollup
+        WHERE program_year = ANY(%s)
+        GROUP BY program_year, manufacturer_id
+    """, (years,))
+
+def backfill_rollups(cur):
+    # Years imported before rollups existed only have raw rows
+    if not max_general_id(cur):
+        return
+    cur.execute("""
+        SELECT import_year::INT FROM cms_open_payments_import_log l
+        WHERE import_year ~ '^[0-9]{4}$'
+          AND NOT EXISTS (
+              SELECT 1 FROM cms_open_payments_general_rollup r
+              WHERE r.program_year = l.import_year::INT
+          )
+        ORDER BY 1
+    """)
+    for (year,) in cur.fetchall():
+        print(f"🔁 Backfilling rollups for {year}")
+        build_rollups(cur, year)
+
 def cleanup_files(data_dir, zip_path):
     print("🧹 Cleaning up extracted CSV files and ZIP archive...")
     for file in os.listdir(data_dir):
@@ -116,7 +289,13 @@ def main():
             );
         """)
         cur.execute("SELECT 1 FROM cms_open_payments_import_log WHERE import_year = %s", (str(year),))
-        if cur.fetchone():
+        already_imported = cur.fetchone() is not None
+
+        create_rollup_tables(cur)
+        backfill_rollups(cur)
+        conn.commit()
+
+        if already_imported:
             print(f"✅ Data for {year} already imported. Skipping.")
             return
 
@@ -125,6 +304,8 @@ def main():
 
         extract_zip(zip_path, data_dir)
 
+        first_general_id = max_general_id(cur)
+
         for file in os.listdir(data_dir):
             if file.endswith(".csv"):
                 full_path = os.path.join(data_dir, file)
@@ -138,6 +319,8 @@ def main():
                     print(f"📥 Importing Ownership Payments – {file}")
                     import_csv_to_table(cur, full_path, "cms_open_payments_ownership_all")
 
+        build_rollups(cur, year, after_id=first_general_id)
+
         cur.execute("INSERT INTO cms_open_payments_import_log (import_year, file_name) VALUES (%s, %s)", (str(year), filename))
         conn.commit()
 
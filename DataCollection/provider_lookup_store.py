@@ -0,0 +1,387 @@
+import os
+import sys
+import mmap
+import time
+import random
+import struct
+import argparse
+from array import array
+from bisect import bisect_left
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Run after the NPPES, DAC and LEIE importers. The data/ directory is wiped by
+# the importers, so the lookup file lives in its own directory.
+LOOKUP_DIR = os.path.join(os.path.dirname(__file__), "lookup")
+LOOKUP_PATH = os.getenv("PROVIDER_LOOKUP_PATH", os.path.join(LOOKUP_DIR, "provider_lookup.bin"))
+
+# File layout (all integers little-endian):
+#   header   magic, version, record count, blob/keys/offsets positions and sizes
+#   blob     packed records, one per NPI, in key order
+#   keys     record count x uint32 NPI, sorted ascending
+#   offsets  (record count + 1) x uint64 offsets into the blob
+# Record i is blob[offsets[i]:offsets[i + 1]]: one flag byte followed by the
+# RECORD_FIELDS joined with FIELD_SEPARATOR and encoded as UTF-8.
+MAGIC = b"NPIL"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIQQQQ4x")
+FIELD_SEPARATOR = b"\x1f"
+FLAG_EXCLUDED = 0x01
+RECORD_FIELDS = ("name", "taxonomy_code", "address_1", "address_2", "city", "state", "postal_code")
+MAX_NPI = 0xFFFFFFFF  # NPIs are 10 digits starting with 1 or 2, so they fit in a uint32
+FETCH_SIZE = 50000
+
+LOOKUP_QUERY = """
+    SELECT p.npi,
+           COALESCE(NULLIF(p.org_name, ''),
+                    NULLIF(btrim(concat_ws(' ', p.first_name, p.last_name)), ''),
+                    NULLIF(btrim(concat_ws(' ', dc.first_name, dc.last_name)), '')) AS name,
+           t.taxonomy_code,
+           CASE WHEN src.use_dac THEN dl.address_1 ELSE a.address_1 END,
+           CASE WHEN src.use_dac THEN CASE WHEN dl.address_suppressed THEN NULL ELSE dl.address_2 END
+                ELSE a.address_2 END,
+           CASE WHEN src.use_dac THEN dl.city ELSE a.city END,
+           CASE WHEN src.use_dac THEN dl.state ELSE a.state END,
+           CASE WHEN src.use_dac THEN LEFT(dl.zip, 5) ELSE a.postal_code END,
+           x.npi IS NOT NULL AS excluded
+    FROM nppes_providers p
+    LEFT JOIN (
+        SELECT DISTINCT ON (npi) npi, taxonomy_code
+        FROM nppes_provider_taxonomies
+        ORDER BY npi, is_primary DESC, id DESC
+    ) t USING (npi)
+    LEFT JOIN (
+        SELECT DISTINCT ON (npi) npi, address_1, address_2, city, state, postal_code
+        FROM nppes_provider_addresses
+        WHERE address_type = 'practice'
+        ORDER BY npi, id DESC
+    ) a USING (npi)
+    LEFT JOIN (
+        SELECT DISTINCT ON (npi) npi, first_name, last_name
+        FROM cms_dac_clinicians
+        ORDER BY npi, id DESC
+    ) dc USING (npi)
+    LEFT JOIN (
+        SELECT DISTINCT ON (npi) npi, address_1, address_2, address_suppressed, city, state, zip
+        FROM cms_dac_practice_locations
+        ORDER BY npi, id DESC
+    ) dl USING (npi)
+    LEFT JOIN (
+        SELECT DISTINCT npi
+        FROM hhs_leie_exclusions
+        WHERE npi IS NOT NULL AND npi <> '' AND npi <> '0000000000'
+    ) x USING (npi)
+    -- Take the whole address from one source: DAC only when NPPES has no street
+    CROSS JOIN LATERAL (
+        SELECT NULLIF(a.address_1, '') IS NULL AND NULLIF(dl.address_1, '') IS NOT NULL AS use_dac
+    ) src
+    {where}
+    ORDER BY p.npi
+"""
+
+def parse_npi(value):
+    try:
+        npi = int(value)
+    except (TypeError, ValueError):
+        return None
+    return npi if 0 < npi <= MAX_NPI else None
+
+def pack_record(fields, excluded):
+    values = [(value or "").replace("\x1f", " ").encode("utf-8") for value in fields]
+    flags = FLAG_EXCLUDED if excluded else 0
+    return bytes((flags,)) + FIELD_SEPARATOR.join(values)
+
+def unpack_record(raw):
+    values = bytes(raw[1:]).decode("utf-8").split("\x1f")
+    record = {field: value or None for field, value in zip(RECORD_FIELDS, values)}
+    record["excluded"] = bool(raw[0] & FLAG_EXCLUDED)
+    return record
+
+def _write_le_array(f, values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(f)
+
+def _pad_to(f, alignment):
+    remainder = f.tell() % alignment
+    if remainder:
+        f.write(b"\0" * (alignment - remainder))
+
+def write_lookup_file(records, path=LOOKUP_PATH):
+    """Write (npi, name, taxonomy_code, address_1, address_2, city, state,
+    postal_code, excluded) rows, sorted by NPI, to a lookup file at path."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    keys = array("I")
+    offsets = array("Q", [0])
+    skipped = 0
+
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        blob_offset = f.tell()
+        for row in records:
+            npi = parse_npi(row[0])
+            if npi is None or (keys and npi <= keys[-1]):
+                skipped += 1
+                continue
+            f.write(pack_record(row[1:8], row[8]))
+            keys.append(npi)
+            offsets.append(f.tell() - blob_offset)
+        blob_size = f.tell() - blob_offset
+
+        _pad_to(f, 8)
+        keys_offset = f.tell()
+        _write_le_array(f, keys)
+        _pad_to(f, 8)
+        offsets_offset = f.tell()
+        _write_le_array(f, offsets)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(keys), blob_offset, blob_size, keys_offset, offsets_offset))
+
+    os.replace(tmp_path, path)
+    if skipped:
+        print(f"⚠️ Skipped {skipped} rows with a missing, invalid or duplicate NPI")
+    print(f"✅ Wrote {len(keys)} providers to {path} ({os.path.getsize(path)} bytes)")
+    return len(keys)
+
+def fetch_lookup_records(conn):
+    cur = conn.cursor(name="provider_lookup_build")
+    cur.itersize = FETCH_SIZE
+    try:
+        cur.execute(LOOKUP_QUERY.format(where=""))
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
+
+def build_lookup_file(conn, path=LOOKUP_PATH):
+    print("📦 Building provider lookup file from NPPES, DAC and LEIE tables")
+    return write_lookup_file(fetch_lookup_records(conn), path)
+
+class ProviderLookupStore:
+    """Read-only, memory-mapped view of a provider lookup file.
+
+    Lookups binary-search the key array in place. get_raw() and get_many_raw()
+    return memoryviews into the mapping; release them before calling close().
+    """
+
+    def __init__(self, path=LOOKUP_PATH):
+        if sys.byteorder != "little":
+            raise RuntimeError("ProviderLookupStore requires a little-endian host")
+        self._path = path
+        # The mapping keeps its own handle on the file, so the file can be closed right away
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._map_views()
+        except Exception:
+            self._release_views()
+            self._mmap.close()
+            self._mmap = None
+            raise
+
+    def _map_views(self):
+        self._view = memoryview(self._mmap)
+        magic, version, _, count, blob_offset, blob_size, keys_offset, offsets_offset = \
+            HEADER.unpack_from(self._view)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self._path} is not a version {VERSION} provider lookup file")
+        self._blob = self._view[blob_offset:blob_offset + blob_size]
+        self._keys = self._view[keys_offset:keys_offset + 4 * count].cast("I")
+        self._offsets = self._view[offsets_offset:offsets_offset + 8 * (count + 1)].cast("Q")
+
+    def _release_views(self):
+        for name in ("_offsets", "_keys", "_blob", "_view"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, npi):
+        return self._index(parse_npi(npi)) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.close()
+        except BufferError:
+            # Don't let a leaked record view hide the exception that ended the block
+            if exc_type is None:
+                raise
+
+    def close(self):
+        """Unmap the file. Calling close() again is a no-op.
+
+        Raises BufferError, leaving the store open and usable, while any view
+        returned by get_raw() or get_many_raw() is still alive.
+        """
+        if self._mmap is None:
+            return
+        self._release_views()
+        try:
+            self._mmap.close()
+        except BufferError:
+            self._map_views()
+            raise BufferError(
+                f"{self._path} is still referenced by record views; "
+                "release the memoryviews from get_raw()/get_many_raw() before close()"
+            ) from None
+        self._mmap = None
+
+    def _index(self, npi, lo=0):
+        if npi is None:
+            return None
+        i = bisect_left(self._keys, npi, lo)
+        if i < len(self._keys) and self._keys[i] == npi:
+            return i
+        return None
+
+    def _raw_at(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]]
+
+    def get_raw(self, npi):
+        i = self._index(parse_npi(npi))
+        return None if i is None else self._raw_at(i)
+
+    def get(self, npi):
+        raw = self.get_raw(npi)
+        if raw is None:
+            return None
+        with raw:
+            return unpack_record(raw)
+
+    def get_many_raw(self, npis):
+        """Return {npi: memoryview} for the NPIs that are present.
+
+        Queries are resolved in sorted order so each binary search starts
+        where the previous one ended.
+        """
+        parsed = sorted(((n, npi) for npi in npis if (n := parse_npi(npi)) is not None),
+                        key=lambda item: item[0])
+        results = {}
+        lo = 0
+        for n, npi in parsed:
+            i = self._index(n, lo)
+            if i is None:
+                continue
+            results[npi] = self._raw_at(i)
+            lo = i
+        return results
+
+    def get_many(self, npis):
+        """Return {npi: record} for the NPIs that are present."""
+        results = {}
+        for npi, raw in self.get_many_raw(npis).items():
+            with raw:
+                results[npi] = unpack_record(raw)
+        return results
+
+    def sample_npis(self, k):
+        return [str(self._keys[i]) for i in random.sample(range(len(self._keys)), min(k, len(self._keys)))]
+
+def _rate(count, seconds):
+    return f"{count / seconds:,.0f}/s" if seconds else "n/a"
+
+def benchmark(conn, path=LOOKUP_PATH, samples=100000, pg_samples=20, pg_seconds=60, opens=100):
+    print(f"📏 File size: {os.path.getsize(path):,} bytes")
+
+    start = time.perf_counter()
+    for _ in range(opens):
+        ProviderLookupStore(path).close()
+    print(f"⏱️ Open time: {(time.perf_counter() - start) / opens * 1000:.3f} ms")
+
+    with ProviderLookupStore(path) as store:
+        print(f"🔢 Providers: {len(store):,}")
+        npis = store.sample_npis(samples)
+
+        start = time.perf_counter()
+        for npi in npis:
+            raw = store.get_raw(npi)
+            raw.release()
+        print(f"⚡ Raw single lookups: {_rate(len(npis), time.perf_counter() - start)}")
+
+        start = time.perf_counter()
+        for npi in npis:
+            store.get(npi)
+        print(f"⚡ Decoded single lookups: {_rate(len(npis), time.perf_counter() - start)}")
+
+        start = time.perf_counter()
+        for raw in store.get_many_raw(npis).values():
+            raw.release()
+        print(f"⚡ Raw batch lookups: {_rate(len(npis), time.perf_counter() - start)}")
+
+        start = time.perf_counter()
+        store.get_many(npis)
+        print(f"⚡ Decoded batch lookups: {_rate(len(npis), time.perf_counter() - start)}")
+
+    if conn is None:
+        return
+
+    # The tables have no index on npi, so each query mostly measures sequential
+    # scans of the NPPES, DAC and LEIE tables. Stop after pg_seconds.
+    cur = conn.cursor()
+    try:
+        done = 0
+        start = time.perf_counter()
+        for npi in npis[:pg_samples]:
+            cur.execute(LOOKUP_QUERY.format(where="WHERE p.npi = %s"), (npi,))
+            cur.fetchall()
+            done += 1
+            if time.perf_counter() - start >= pg_seconds:
+                break
+        if not done:
+            return
+        elapsed = time.perf_counter() - start
+        print(f"🐘 Postgres single lookups: {_rate(done, elapsed)} "
+              f"({elapsed / done * 1000:,.1f} ms per lookup over {done} lookups)")
+
+        start = time.perf_counter()
+        cur.execute(LOOKUP_QUERY.format(where="WHERE p.npi = ANY(%s)"), (npis[:done],))
+        cur.fetchall()
+        print(f"🐘 Postgres batch lookups: {_rate(done, time.perf_counter() - start)}")
+    finally:
+        cur.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or benchmark the provider lookup file.")
+    parser.add_argument("--path", default=LOOKUP_PATH)
+    parser.add_argument("--benchmark", action="store_true", help="benchmark the existing file against Postgres")
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--pg-samples", type=int, default=20)
+    parser.add_argument("--pg-seconds", type=float, default=60, help="time limit for the Postgres single lookups")
+    args = parser.parse_args()
+
+    conn = None
+    try:
+        try:
+            conn = psycopg2.connect(
+                host=os.getenv("DB_HOST"),
+                database=os.getenv("DB_NAME"),
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD")
+            )
+        except psycopg2.Error as e:
+            # The benchmark only needs Postgres for the comparison; building does not work without it
+            if not args.benchmark:
+                raise
+            print(f"⚠️ Postgres unavailable, skipping the Postgres comparison: {e}")
+        if args.benchmark:
+            benchmark(conn, args.path, args.samples, args.pg_samples, args.pg_seconds)
+        else:
+            build_lookup_file(conn, args.path)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    main()